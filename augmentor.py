@@ -1,28 +1,56 @@
 import os
-import glob
+import io
+import hashlib
+import time
+import itertools
+import math
 import argparse
 import random
 from pathlib import Path
 from pprint import pprint
 
-import imagehash
+import numpy as np
 from PIL import Image, ImageOps
-import progressbar
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import Manager
+from multiprocessing.util import Finalize
 from termcolor import colored
 
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # Optional, required only by `--backend cv2`
+try:
+    # Parallelism comes from worker processes, libvips threads would oversubscribe CPU (read on libvips init)
+    os.environ.setdefault('VIPS_CONCURRENCY', '1')
+    import pyvips
+except ImportError:
+    pyvips = None  # Optional, required only by `--backend vips`
+try:
+    import xxhash
+except ImportError:
+    xxhash = None  # Optional, faster file hashing for `--dedupe-input` (MD5 is used otherwise)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_BGR, TJSAMP_444, TJSAMP_422, TJSAMP_420
+except ImportError:
+    TurboJPEG = None  # Optional, faster JPEG encoding for 'pil' and 'cv2' backends with `--no-jpg-optimize`
 
 stats = {
     'images_collected': 0,
     'images_duplicated': 0,
 }
-hashes = []  # Image hashes
+hashes = {}  # Image hashes {hash: file}, replaced by a shared dict in workers when deduplicating input
+file_hashes = {}  # File content hashes {hash: file}, replaced by a shared dict in workers when deduplicating input
 hash_size = 15
+io_pool = None  # Background threads writing output files, one pool per worker process
+sample_crops = None  # Random crops generator specialized for config, one per worker process
+turbo_jpeg = None  # TurboJPEG encoder, one per worker process (None if not available)
+crops_buffer = None  # Output buffer for all crops of single image (cv2 backend), reused by every image in the process
 
 
-def get_max_window_size(image: Image, ratio: float):
+def get_max_window_size(size: tuple, ratio: float):
     """ Returns maximum size (width, height) of inscribed rectangle with specific aspect ratio """
-    width, height = image.size
+    width, height = size
     current_ratio = width / height
     if ratio == current_ratio:
         return width, height
@@ -32,6 +60,309 @@ def get_max_window_size(image: Image, ratio: float):
         return round(height * ratio), height
 
 
+def iter_jpgs(root: str, recursive: bool):
+    """ Yields paths of JPEG files in `root` directory as they are found """
+    extensions = ('.jpg', '.jpeg')
+    stack = [root]
+    visited = set()  # (st_dev, st_ino) of walked directories, symlink cycles are not followed
+    while stack:
+        directory = stack.pop()
+        # Unreadable or meanwhile removed directory is skipped the same way glob does
+        try:
+            directory_stat = os.stat(directory)
+            if (directory_stat.st_dev, directory_stat.st_ino) in visited:
+                continue
+            visited.add((directory_stat.st_dev, directory_stat.st_ino))
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue  # Skip hidden files the same way glob does
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if recursive:
+                    stack.append(entry.path)
+            elif entry.name.lower().endswith(extensions):
+                yield entry.path
+
+
+def reservoir_sample(iterable, k: int):
+    """ Returns `k` randomly selected items of iterable (or all of them if there is less) and count of all items """
+    sample = []
+    count = 0
+    for count, item in enumerate(iterable, start=1):
+        if count <= k:
+            sample.append(item)
+        else:
+            i = random.randrange(count)
+            if i < k:
+                sample[i] = item
+    return sample, count
+
+
+def get_draft_size():
+    """ Returns smallest size (width, height) the source image can be decoded to without losing output quality """
+    if config.scale_min <= 0:
+        return None  # Windows of any size, full resolution is needed
+    # Keep at least 2x of the output size, or more if windows may be smaller (scale_min < 0.5)
+    factor = max(2, 1 / config.scale_min)
+    return math.ceil(config.width * factor), math.ceil(config.height * factor)
+
+
+def is_vips(image):
+    """ Is image loaded by vips backend? """
+    return pyvips is not None and isinstance(image, pyvips.Image)
+
+
+def vips_to_array(image):
+    """ Converts (evaluates) vips image to numpy array of shape (height, width, bands) """
+    return np.ndarray(buffer=image.write_to_memory(), dtype=np.uint8, shape=(image.height, image.width, image.bands))
+
+
+def get_file_hash(file: str):
+    """ Returns hash of file content as bytes (xxHash if available, otherwise MD5) """
+    file_hash = xxhash.xxh64() if xxhash else hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.digest()
+
+
+def get_gray_thumbnail(image, width: int, height: int):
+    """ Returns grayscale thumbnail of image loaded by any backend as numpy array of shape (height, width) """
+    if isinstance(image, np.ndarray):
+        return cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (width, height), interpolation=cv2.INTER_AREA)
+    if is_vips(image):
+        return vips_to_array(image.thumbnail_image(width, height=height, size='force').colourspace('b-w'))[:, :, 0]
+    return np.asarray(image.resize((width, height), Image.BOX).convert('L'), dtype=np.uint8)
+
+
+def ahash_fast(image, n: int = hash_size):
+    """ Average hash (aHash) of image as hashable bytes (resize -> grayscale -> compare to mean) """
+    arr = get_gray_thumbnail(image, n, n)
+    bits = (arr > arr.mean()).ravel()
+    return np.packbits(bits).tobytes()
+
+
+def dhash_batch(images, n: int = 8):
+    """ Difference hashes (dHash) of images as list of hashable bytes (resize -> grayscale -> compare neighbour pixels) """
+    if isinstance(images, np.ndarray):
+        # Batch of BGR crops (count, height, width, 3): grayscale of the thumbnails at once (resize and grayscale commute)
+        thumbnails = np.stack([cv2.resize(image, (n + 1, n), interpolation=cv2.INTER_AREA) for image in images])
+        arr = thumbnails.astype(np.float32) @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+    else:
+        arr = np.stack([get_gray_thumbnail(image, n + 1, n) for image in images]).astype(np.int16)
+    bits = (np.diff(arr, axis=2) > 0).reshape(len(arr), -1)
+    return [row.tobytes() for row in np.packbits(bits, axis=1)]
+
+
+def load_image(file: str):
+    """ Loads image for selected backend (PIL.Image, BGR numpy array for cv2 or pyvips.Image) """
+    if config.backend == 'cv2':
+        # EXIF orientation is ignored the same way as by PIL and vips backends
+        image = cv2.imdecode(np.fromfile(file, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            raise ValueError("Unsupported or corrupted image")
+        return image
+
+    if config.backend == 'vips':
+        return load_image_vips(file)
+
+    # File is closed right after decoding, convert() returns an independent image
+    with Image.open(file) as image:
+        # JPEG can be decoded directly in 1/2, 1/4 or 1/8 scale (the size stays >= draft size)
+        draft_size = get_draft_size()
+        if draft_size:
+            image.draft('RGB', draft_size)
+        return image.convert('RGB')
+
+
+def load_image_vips(file: str):
+    """ Loads JPEG image by libvips, shrunk on load the same way as PIL draft mode """
+    header = pyvips.Image.new_from_file(file)  # Header only, pixels are not decoded yet
+    draft_size = get_draft_size()
+    shrink = 1
+    if draft_size:
+        for factor in (2, 4, 8):
+            if header.width // factor >= draft_size[0] and header.height // factor >= draft_size[1]:
+                shrink = factor
+
+    # Sequential access streams the image without keeping it decoded in memory,
+    # but it can be read only once (single crop without input hash)
+    access = 'sequential' if config.crops == 1 and not config.dedupe_input else 'random'
+    image = pyvips.Image.jpegload(file, shrink=shrink, access=access)
+    if image.interpretation != 'srgb':
+        image = image.colourspace('srgb')
+    return image
+
+
+def get_image_size(image):
+    """ Returns size (width, height) of image loaded by any backend """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    if is_vips(image):
+        return image.width, image.height
+    return image.size
+
+
+def get_crops_buffer():
+    """ Returns preallocated array of shape (crops, height, width, 3) for crops of single image """
+    global crops_buffer
+    if crops_buffer is None:
+        crops_buffer = np.empty((config.crops, config.height, config.width, 3), dtype=np.uint8)
+    return crops_buffer
+
+
+def crop_resize(image, crop_box: tuple, out=None):
+    """ Crops `crop_box` (left, top, right, bottom) of image and resizes it to the output size (into `out` array for cv2) """
+    if isinstance(image, np.ndarray):
+        left, top, right, bottom = crop_box
+        # Crop is a numpy view, no copy
+        return cv2.resize(image[top:bottom, left:right], (config.width, config.height), dst=out, interpolation=cv2.INTER_AREA)
+    if is_vips(image):
+        left, top, right, bottom = crop_box
+        window_width, window_height = right - left, bottom - top
+        image = image.extract_area(left, top, window_width, window_height)
+        image = image.resize(config.width / window_width, vscale=config.height / window_height, kernel='lanczos3')
+        return image.copy_memory()  # Evaluate the pipeline once, the crop is hashed and saved later
+    # Resample directly from the crop box of the source (no intermediate cropped image)
+    return image.resize((config.width, config.height), resample=Image.BICUBIC, box=crop_box, reducing_gap=2.0)
+
+
+def autocontrast(image, cutoff: float):
+    """ Autocontrast of image loaded by any backend (numpy array is modified in place) """
+    if isinstance(image, np.ndarray):
+        # Autocontrast works per channel, so BGR can be passed as RGB
+        image[:] = np.asarray(ImageOps.autocontrast(Image.fromarray(image), cutoff=cutoff))
+        return image
+    if is_vips(image):
+        arr = np.asarray(ImageOps.autocontrast(Image.fromarray(vips_to_array(image)), cutoff=cutoff))
+        return pyvips.Image.new_from_memory(arr.tobytes(), image.width, image.height, image.bands, 'uchar')
+    return ImageOps.autocontrast(image, cutoff=cutoff)
+
+
+def encode_image(image):
+    """ Encodes image loaded by any backend to bytes in `config.format` """
+    # libjpeg-turbo straight from numpy array (vips has its own encoder)
+    if turbo_jpeg is not None and config.format == 'jpg' and not is_vips(image):
+        if isinstance(image, np.ndarray):
+            arr, pixel_format = image, TJPF_BGR
+        else:
+            arr, pixel_format = np.asarray(image), TJPF_RGB
+        jpeg_subsample = [TJSAMP_444, TJSAMP_422, TJSAMP_420][config.subsampling]
+        return turbo_jpeg.encode(arr, quality=config.jpg_quality, pixel_format=pixel_format, jpeg_subsample=jpeg_subsample)
+
+    if isinstance(image, np.ndarray):
+        params = [cv2.IMWRITE_JPEG_QUALITY, config.jpg_quality, cv2.IMWRITE_JPEG_OPTIMIZE, int(config.jpg_optimize)]
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):  # OpenCV >= 4.5.5
+            sampling_factors = [cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, sampling_factors[config.subsampling]]
+        return cv2.imencode('.' + config.format, image, params)[1].tobytes()
+    if is_vips(image):
+        if config.format == 'jpg':
+            # libvips supports only 4:4:4 and 4:2:0
+            subsample_mode = 'off' if config.subsampling == 0 else 'on'
+            return image.jpegsave_buffer(Q=config.jpg_quality, subsample_mode=subsample_mode, optimize_coding=config.jpg_optimize)
+        return image.pngsave_buffer()
+    buffer = io.BytesIO()
+    if config.format == 'jpg':
+        # Progressive JPEG is slower to encode and decode
+        image.save(buffer, format='JPEG', quality=config.jpg_quality, subsampling=config.subsampling, optimize=config.jpg_optimize, progressive=False)
+    else:
+        image.save(buffer, format='PNG')  # PNG `optimize` means the slowest zlib level, JPEG options don't apply
+    return buffer.getvalue()
+
+
+def write_file(file_name: str, data: bytes):
+    """ Writes encoded image to disk (runs in IO thread). Returns True on success. """
+    try:
+        Path(file_name).write_bytes(data)
+    except Exception as e:
+        print(file_name, colored("ERROR", 'red'), colored("Saving image failed", 'yellow'), e)
+        return False
+    return True
+
+
+def save_image(image, file_name: str):
+    """ Encodes image in the current thread and hands writing of the file over to IO thread. Returns future of write_file(). """
+    data = encode_image(image)
+    if io_pool is None:
+        future = Future()
+        future.set_result(write_file(file_name, data))
+        return future
+    return io_pool.submit(write_file, file_name, data)
+
+
+def make_crops_sampler():
+    """
+    Returns generator function yielding `config.crops` random crops (crop_box, apply_autocontrast, cutoff)
+    of image with given size. Config values are bound as constants of the closure once per process.
+    """
+    width, ratio, crops = config.width, config.width / config.height, config.crops
+    scale_min_config, scale_max = config.scale_min, config.scale_max
+    autocontrast_probability = config.autocontrast
+    cutoff_min, cutoff_max = config.cutoff_min, config.cutoff_max
+    uniform, randint, rand = random.uniform, random.randint, random.random
+
+    def sample_crops(image_width: int, image_height: int):
+        window_max_width, window_max_height = get_max_window_size((image_width, image_height), ratio)
+        scale_min = max(width / window_max_width, scale_min_config)
+        for _ in range(crops):
+            # Random window
+            scale = uniform(scale_min, scale_max)  # Random scale
+            window_width = round(scale * window_max_width)
+            window_height = round(scale * window_max_height)
+            left = randint(0, image_width - window_width)
+            top = randint(0, image_height - window_height)
+            crop_box = (left, top, left + window_width, top + window_height)
+
+            # Autocontrast with `config.autocontrast` probability
+            apply_autocontrast = rand() < autocontrast_probability
+            cutoff = uniform(cutoff_min, cutoff_max) if apply_autocontrast else 0.0
+            yield crop_box, apply_autocontrast, cutoff
+
+    return sample_crops
+
+
+def is_turbo_jpeg_available():
+    """ Can TurboJPEG encoder be used? (PyTurboJPEG installed and libturbojpeg library found) """
+    if TurboJPEG is None:
+        return False
+    try:
+        TurboJPEG()
+    except (OSError, RuntimeError):
+        return False  # libturbojpeg library not found, PIL/cv2 encoder is used
+    return True
+
+
+def init_worker(worker_config, worker_hashes, worker_file_hashes, use_turbo_jpeg):
+    """ Initialize globals in worker process """
+    global config, hashes, file_hashes, io_pool, turbo_jpeg, sample_crops
+    config = worker_config
+    sample_crops = make_crops_sampler()
+    Image.preinit()  # Load common image plugins once, not on the first image
+    if cv2 is not None:
+        cv2.setNumThreads(1)  # Parallelism comes from worker processes, OpenCV threads would oversubscribe CPU
+    if worker_hashes is not None:
+        hashes = worker_hashes
+    if worker_file_hashes is not None:
+        file_hashes = worker_file_hashes
+
+    # Disk writes overlap with encoding of the other variants. The pool is shut down on worker
+    # exit (multiprocessing runs finalizers, not atexit handlers, in child processes)
+    io_pool = ThreadPoolExecutor(max_workers=2)
+    Finalize(None, io_pool.shutdown, kwargs={'wait': True}, exitpriority=10)
+
+    if use_turbo_jpeg:
+        turbo_jpeg = TurboJPEG()
+
+
 def print_config():
     """ Print setup """
     for arg in vars(config):
@@ -43,112 +374,174 @@ def print_config():
 
 
 def process_image(file: str):
-    """ Augmentation process of single image """
-    global stats
+    """ Augmentation process of single image. Returns stats of the image. """
+    image_stats = {
+        'images_collected': 0,
+        'images_duplicated': 0,
+    }
+
+    # Skip exact duplicity of already accepted file before decoding it
+    if config.dedupe_input:
+        try:
+            file_hash = get_file_hash(file)
+        except Exception as e:
+            print(file, colored("ERROR", 'red'), colored("Reading file failed", 'yellow'), e)
+            return image_stats
+        if file_hash in file_hashes:
+            print(file, colored("DUPLICATE ", 'red'))
+            image_stats['images_duplicated'] += 1
+            return image_stats
 
     # Load image
     try:
-        image_original = Image.open(file).convert('RGB')
+        image_original = load_image(file)
     except Exception as e:
         print(file, colored("ERROR", 'red'), colored("Loading image failed", 'yellow'), e)
-        return
+        return image_stats
 
     # Skip images smaller then required size
-    if image_original.width < config.width or image_original.height < config.height:
+    image_width, image_height = get_image_size(image_original)
+    if image_width < config.width or image_height < config.height:
         print(file, colored("SKIPPED (too small)", 'red'))
-        return
+        return image_stats
 
     # Skip duplicity image
     if config.dedupe_input:
-        image_hash = imagehash.average_hash(image_original, hash_size=hash_size)
-        if image_hash in hashes:
+        # File hash is claimed only by accepted (loaded, big enough) files, so copies of
+        # rejected files get the same verdict. Same-bytes file claimed meanwhile by another worker is a duplicity.
+        if file_hashes.setdefault(file_hash, file) != file:
             print(file, colored("DUPLICATE ", 'red'))
-            stats['images_duplicated'] += 1
-            return
-        hashes.append(image_hash)
+            image_stats['images_duplicated'] += 1
+            return image_stats
 
-    stem = Path(file).stem
-    window_max = get_max_window_size(image_original, config.width / config.height)
+        image_hash = ahash_fast(image_original)
+        # setdefault() is a single (atomic) call on the shared dict, so two workers can't both claim the same hash
+        if hashes.setdefault(image_hash, file) != file:
+            print(file, colored("DUPLICATE ", 'red'))
+            image_stats['images_duplicated'] += 1
+            return image_stats
 
-    variants = {}  # {filename : PIL.Image}
-    for n in range(1, config.crops + 1):
-        image = image_original.copy()
+    stem = Path(file).stem
+    output_dir, output_format, randomize = config.output_dir, config.format, config.randomize
 
-        # Autocontrast with `config.autocontrast` probability
-        if random.random() < config.autocontrast:
-            cutoff = random.uniform(config.cutoff_min, config.cutoff_max)
-            image = ImageOps.autocontrast(image, cutoff=cutoff)
-        else:
-            cutoff = False
+    # cv2 resizes into preallocated buffer (one slot per variant)
+    buffer = get_crops_buffer() if isinstance(image_original, np.ndarray) else None
 
-        # Random window
-        scale_min = config.width / window_max[0]
-        scale = random.uniform(max(scale_min, config.scale_min), config.scale_max)  # Random scale
-        window_width = round(scale * window_max[0])
-        window_height = round(scale * window_max[1])
-        left = random.randint(0, image.width - window_width)
-        top = random.randint(0, image.height - window_height)
-        crop_box = (left, top, left + window_width, top + window_height)
+    variants = {}  # {filename : image}
+    seen_boxes = set()  # Same crop box and cutoff always gives the same variant
+    for n, (crop_box, apply_autocontrast, cutoff) in enumerate(sample_crops(image_width, image_height), start=1):
+        # Skip duplicity variant before any pixel work
+        box_key = (crop_box, apply_autocontrast, round(cutoff, 2))
+        if box_key in seen_boxes:
+            continue
+        seen_boxes.add(box_key)
 
-        # todo Zkusit jestli resize+box ned stejný výsledej
-        image_cropped = image.crop(crop_box).resize((config.width, config.height), resample=3, box=None, reducing_gap=None)
+        image_cropped = crop_resize(image_original, crop_box, out=None if buffer is None else buffer[len(variants)])
+        # Autocontrast on the output size (the histogram is nearly identical to the source)
+        if apply_autocontrast:
+            image_cropped = autocontrast(image_cropped, cutoff)
 
         # centering = (random.uniform(0, 1), random.uniform(0, 1))
         # image_cropped = ImageOps.fit(image, size=(config.width, config.height), method=Image.ANTIALIAS, bleed=0, centering=centering)
-        if config.randomize:
-            outfile = f"{config.output_dir}/{n}-{stem}--ac{cutoff:.2f}.{config.format}"
+        if randomize:
+            outfile = f"{output_dir}/{n}-{stem}--ac{cutoff:.2f}.{output_format}"
         else:
-            outfile = f"{config.output_dir}/{stem}-{n}--ac{cutoff:.2f}.{config.format}"
+            outfile = f"{output_dir}/{stem}-{n}--ac{cutoff:.2f}.{output_format}"
         variants[outfile] = image_cropped
 
+    # Release the source image before saving, only the variants are needed
+    del image_original
+
     # Save varinats (skip duplicities)
-    variants_hashes = []
-    variants_saved = 0
-    for file_name, image in variants.items():
-        variant_hash = imagehash.average_hash(image, hash_size=hash_size)
+    variants_hashes = set()
+    writes = []  # Futures of pending writes
+    batch = list(variants.values()) if buffer is None else buffer[:len(variants)]
+    for (file_name, image), variant_hash in zip(variants.items(), dhash_batch(batch)):
         if variant_hash in variants_hashes:
             continue
-        variants_hashes.append(variant_hash)
-        image.save(file_name, quality=config.jpg_quality, subsampling=0)
-        variants_saved += 1
+        variants_hashes.add(variant_hash)
+        writes.append(save_image(image, file_name))
 
-    stats['images_collected'] += variants_saved
+    # Writes overlap with encoding of the other variants, only successfully written ones are counted
+    variants_saved = sum(future.result() for future in writes)
+    image_stats['images_collected'] += variants_saved
     print(file, colored("OK", 'green'), colored(str(variants_saved), 'cyan'))
+    return image_stats
 
 
-def run():
-    # Print setup
-    print_config()
+def print_summary(images_found: int, images_selected: int):
+    """ Print count of input images and expected output images """
+    print("Input images found:         ", images_found)
+    print("Input images selected:      ", images_selected)
+    print("Expected output images (max):     ", images_selected * config.crops)
 
-    # Get list of files
-    # @todo Musi se prochazet i JPG jpeg JPEG png PNG apod.
-    if config.recursive:
-        files = glob.glob(config.input_dir + '/**/*.jpg', recursive=True)
-    else:
-        files = glob.glob(config.input_dir + '/*.jpg')
 
-    images_found = len(files)
-    if config.limit:
-        try:
-            files = random.sample(files, config.limit)
-        except Exception:
-            pass  # Images count is less then limit. Using all images found.
+def print_progress(done: int, total: int, elapsed: float):
+    """ Print count of processed images and speed """
+    count = f"{done}/{total}" if total is not None else str(done)
+    print(colored(f"Processed {count} images, {done / max(elapsed, 1e-9):.1f} img/s", 'cyan'), flush=True)
 
-    print("Input images found:         ", images_found)
-    print("Input images selected:      ", len(files))
-    print("Expected output images (max):     ", len(files) * config.crops)
 
-    # If dry run or no images found, exit.
-    if config.dry or len(files) <= 0:
-        exit()
+def run():
+    # Print setup
+    print_config()
 
-    # Process images
+    # Get files
+    # @todo Musi se prochazet i png PNG apod.
+    files = iter_jpgs(config.input_dir, config.recursive)
+    files_count = None  # Unknown while streaming
+    if config.limit or config.dry:
+        # Whole tree has to be walked to select samples or count images
+        if config.limit:
+            files, images_found = reservoir_sample(files, config.limit)
+        else:
+            files = list(files)
+            images_found = len(files)
+        files_count = len(files)
+        print_summary(images_found, files_count)
+
+        # If dry run or no images found, exit.
+        if config.dry or files_count <= 0:
+            exit()
+    else:
+        # Peek the first file only, to exit early if no images found
+        first_file = next(files, None)
+        if first_file is None:
+            print_summary(0, 0)
+            exit()
+        files = itertools.chain([first_file], files)
+
+    # Process images (files are streamed to workers while the walker is still enumerating)
     os.makedirs(config.output_dir, exist_ok=True)
 
-    print(len(files))
-    results = ThreadPool(config.threads).imap_unordered(process_image, files)
-    for result in progressbar.progressbar(results, max_value=len(files), redirect_stdout=True):
-        continue
+    # Probed once here, workers just follow the result. TurboJPEG can't optimize Huffman tables,
+    # so it is used only with --no-jpg-optimize (output doesn't depend on installed libraries)
+    use_turbo_jpeg = not config.jpg_optimize and is_turbo_jpeg_available()
+
+    # Workers don't share memory, so input hashes live in a manager process
+    if config.dedupe_input:
+        manager = Manager()
+        shared_hashes, shared_file_hashes = manager.dict(), manager.dict()
+    else:
+        shared_hashes, shared_file_hashes = None, None
+    with ProcessPoolExecutor(max_workers=config.threads, initializer=init_worker, initargs=(config, shared_hashes, shared_file_hashes, use_turbo_jpeg)) as executor:
+        results = executor.map(process_image, files, chunksize=8)
+        done = 0
+        time_start = last_print = time.monotonic()
+        for image_stats in results:
+            for key, value in image_stats.items():
+                stats[key] += value
+            done += 1
+            # Print progress at most every 250 ms (not on every image)
+            now = time.monotonic()
+            if now - last_print >= 0.25:
+                last_print = now
+                print_progress(done, files_count, now - time_start)
+        print_progress(done, files_count, time.monotonic() - time_start)
+
+    # Streamed files are counted once processed
+    if files_count is None:
+        print_summary(done, done)
 
     pprint(stats)
     print("Total collected images:", stats['images_collected'])
@@ -163,14 +556,17 @@ parser.add_argument('-o', '--output-dir', type=str, default='./augmentor-output/
 parser.add_argument("--recursive", help="Parse 'input_dir' recursively including all subfolders", action='store_true')
 parser.add_argument("--limit", help="Process only 'limit' randomly selected samples from 'input-dir'", type=int)
 parser.add_argument("--dry", help="Dry run. Only show config and calculate expected images count after augmentation.", action='store_true')
-parser.add_argument("--threads", help="Threads count. (default: Number physical CPU cores)", type=int, default=6)
+parser.add_argument("--threads", help="Worker processes count. (default: %(default)s)", type=int, default=6)
 parser.add_argument("--dedupe-input", help="Deduplicate images on input", action='store_true')
+parser.add_argument("--backend", help="Image processing library. 'cv2' requires opencv-python, 'vips' requires pyvips. (default: %(default)s)", type=str, default='pil', choices=['pil', 'cv2', 'vips'])
 
 # Output image format
 parser.add_argument('--width', type=int, default=1024, help='Final output image width (default: %(default)s)')
 parser.add_argument('--height', type=int, default=1024, help='Final output image height (default: %(default)s)')
 parser.add_argument("--format", help="Ouput image format", type=str, default='jpg', choices=['jpg', 'png'])
-parser.add_argument("--jpg-quality", help="JPEG quality (default: %(default)s)", type=int, default=100)
+parser.add_argument("--jpg-quality", help="JPEG quality [1..100]. Lower values encode faster and produce smaller files; 85-92 is visually lossless for most augmentation use cases. (default: %(default)s)", type=int, default=90)
+parser.add_argument("--subsampling", help="JPEG chroma subsampling 0 = 4:4:4, 1 = 4:2:2, 2 = 4:2:0 (default: %(default)s)", type=int, default=2, choices=[0, 1, 2])
+parser.add_argument("--no-jpg-optimize", help="Disable optimization of JPEG Huffman tables. Enables faster TurboJPEG encoder if PyTurboJPEG is installed.", dest='jpg_optimize', action='store_false')
 parser.add_argument("--randomize", help="Random image preffix to randomize order", action='store_true')
 
 # @todo Implement --size
@@ -191,6 +587,11 @@ parser.add_argument("--cutoff-max", help="Maximum autocontrast cutoff. Maximum p
 # parser.add_argument("--flip", help="Vertical flip probability", type=int, default=0)
 # parser.add_argument("--rotate", help="Rotate 90 degrees probability", type=int, default=0)
 
-# Run
-config = parser.parse_args()
-run()
+# Run (guarded, worker processes may re-import this module)
+if __name__ == '__main__':
+    config = parser.parse_args()
+    if config.backend == 'cv2' and cv2 is None:
+        parser.error("--backend cv2 requires opencv-python (pip install opencv-python)")
+    if config.backend == 'vips' and pyvips is None:
+        parser.error("--backend vips requires pyvips (pip install pyvips)")
+    run()